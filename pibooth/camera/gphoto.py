@@ -178,7 +178,7 @@ class GpCamera(BaseCamera):
             config = self._cam.get_config()
             child = config.get_child_by_name(section).get_child_by_name(option)
             if child.get_type() == gp.GP_WIDGET_RADIO:
-                choices = [c for c in child.get_choices()]
+                choices = list(child.get_choices())
             else:
                 choices = None
             data_type = type(child.get_value())
@@ -3,105 +3,191 @@
 """Pibooth diagnostic module.
 """
 
-import io
 import sys
-from PIL import Image
+import atexit
+import argparse
+import functools
+from operator import itemgetter
 try:
     import gphoto2 as gp
 except ImportError:
     gp = None  # gphoto2 is optional
 import pibooth
 from pibooth.config import PiConfigParser
-from pibooth.utils import configure_logging
+from pibooth.utils import configure_logging, PoolingTimer
 from pibooth.plugins import create_plugin_manager
 
 
 LOGFILE = None
 APPNAME = 'diagnostic'
 
+if gp is not None:
+    GP_WIDGET_TYPES = {gp.GP_WIDGET_WINDOW: "Window toplevel",
+                       gp.GP_WIDGET_SECTION: "Section (or Tab)",
+                       gp.GP_WIDGET_TEXT: "Text",
+                       gp.GP_WIDGET_RANGE: "Slider",
+                       gp.GP_WIDGET_TOGGLE: "Toggle button (or check box)",
+                       gp.GP_WIDGET_RADIO: "Radio button",
+                       gp.GP_WIDGET_MENU: "Menu widget (same as Radio)",
+                       gp.GP_WIDGET_BUTTON: "Button press",
+                       gp.GP_WIDGET_DATE: "Date entering",
+                       }
+else:
+    GP_WIDGET_TYPES = {}
+
+# Camera configuration tree shared by the get/set helpers: (camera_id, config)
+_CONFIG_CACHE = None
+# Changes of the cached configuration tree not sent to the camera:
+# (section, option, value)
+_CONFIG_PENDING = []
+
 
 def gp_logging(level, domain, string, data=None):
-    write_log('Gphoto2: {}: {}'.format(domain, string))
+    # Only errors are echoed on stdout, gPhoto2 can be very talkative
+    write_log('Gphoto2: {}: {}'.format(domain, string), echo=level == gp.GP_LOG_ERROR)
 
 
-def write_log(text, new_section=False):
-    """Write text in the log file"""
-    global LOGFILE
-    if not LOGFILE:
-        LOGFILE = open(APPNAME + '.log', 'w')
+def flush_log():
+    """Write the buffered lines in the log file"""
+    LOGFILE.flush()
 
+
+def write_log(text, new_section=False, echo=True):
+    """Write text in the log file"""
     if new_section:
         print('\n' + '=' * 80)
         LOGFILE.write('\n' + '=' * 80 + '\n')
 
-    text = str(text)
-    print(text[:200])
-    if len(text) > 200:
-        print("[... -> see log file for full message]")
-    LOGFILE.write(text + '\n')
+    if not isinstance(text, str):
+        text = str(text)
+    if echo:
+        if len(text) > 200:
+            print(text[:200])
+            print("[... -> see log file for full message]")
+        else:
+            print(text)
+    LOGFILE.write(text)
+    LOGFILE.write('\n')
 
 
-def print_config(config, parent=''):
-    """Print all parameters of the camera"""
+def write_step(text, new_section=False):
+    """Write text in the log file and flush it. Shall be used before any
+    camera operation which may crash the process (gPhoto2 segfault), else
+    the last lines (often the useful ones) are lost.
+    """
+    write_log(text, new_section)
+    flush_log()
 
-    gp_widget_types = {gp.GP_WIDGET_WINDOW: "Window toplevel",
-                       gp.GP_WIDGET_SECTION: "Section (or Tab)",
-                       gp.GP_WIDGET_TEXT: "Text",
-                       gp.GP_WIDGET_RANGE: "Slider",
-                       gp.GP_WIDGET_TOGGLE: "Toggle button (or check box)",
-                       gp.GP_WIDGET_RADIO: "Radio button",
-                       gp.GP_WIDGET_MENU: "Menu widget (same as Radio)",
-                       gp.GP_WIDGET_BUTTON: "Button press",
-                       gp.GP_WIDGET_DATE: "Date entering",
-                       }
 
-    for child in config.get_children():
+def print_config(config):
+    """Print all parameters of the camera"""
+    # Depth-first walk using an explicit stack (children pushed in reverse
+    # order to keep the camera order), deep trees don't hit recursion limit
+    stack = [(child, '') for child in reversed(list(config.get_children()))]
+    while stack:
+        child, parent = stack.pop()
         path = '/'.join((parent, child.get_name()))
-        if child.get_type() == gp.GP_WIDGET_SECTION:
-            print_config(child, path)
+        wtype = child.get_type()
+        if wtype == gp.GP_WIDGET_SECTION:
+            stack.extend((sub, path) for sub in reversed(list(child.get_children())))
         else:
+            value = child.get_value()
             write_log('{}'.format(path))
             write_log('  Label       : {}'.format(child.get_label()))
             write_log('  Readonly    : {}'.format('yes' if child.get_readonly() else 'no'))
-            write_log('  Data type   : {}'.format(type(child.get_value())))
-            write_log('  Widget type : {}'.format(gp_widget_types[child.get_type()]))
-            write_log('  Current     : {}'.format(child.get_value()))
-            if child.get_type() == gp.GP_WIDGET_RADIO:
-                write_log('  Choices     : {}'.format([c for c in child.get_choices()]))
-            elif child.get_type() == gp.GP_WIDGET_RANGE:
+            write_log('  Data type   : {}'.format(type(value)))
+            write_log('  Widget type : {}'.format(GP_WIDGET_TYPES.get(wtype, 'Unknown')))
+            write_log('  Current     : {}'.format(value))
+            if wtype in (gp.GP_WIDGET_RADIO, gp.GP_WIDGET_MENU):
+                write_log('  Choices     : {}'.format(list(child.get_choices())))
+            elif wtype == gp.GP_WIDGET_RANGE:
                 write_log('  Choices     : min={}, max={}, step={}'.format(*child.get_range()))
-            elif child.get_type() == gp.GP_WIDGET_TOGGLE:
+            elif wtype == gp.GP_WIDGET_TOGGLE:
                 write_log('  Choices     : [0, 1]')
-            elif child.get_type() == gp.GP_WIDGET_MENU:
-                write_log('  Choices     : {}'.format([child.get_choice(n) for n in range(child.count_choices())]))
             else:
                 write_log('  Choices     : n/a')
 
 
+def get_config(camera):
+    """Return the configuration tree of the camera.
+
+    The tree is fetched only once (each fetch is a USB transaction with
+    the DSLR) and kept until :py:func:`invalidate_config` is called.
+    """
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None or _CONFIG_CACHE[0] != id(camera):
+        _CONFIG_CACHE = (id(camera), camera.get_config())
+    return _CONFIG_CACHE[1]
+
+
+def invalidate_config():
+    """Drop the cached configuration tree (and its pending changes), next
+    access will fetch it again.
+    """
+    global _CONFIG_CACHE
+    _CONFIG_CACHE = None
+    del _CONFIG_PENDING[:]
+
+
+def flush_config(camera):
+    """Send the cached configuration tree to the camera in one transaction
+    if it has pending changes.
+
+    If the camera rejects it, the pending options are retried one by one
+    to find which one is refused.
+    """
+    if not _CONFIG_PENDING:
+        return
+    pending = list(_CONFIG_PENDING)
+    try:
+        write_step('Applying configuration on DSLR')
+        camera.set_config(get_config(camera))
+        del _CONFIG_PENDING[:]
+        return
+    except gp.GPhoto2Error as ex:
+        invalidate_config()
+        write_log('   -> configuration rejected by DSLR: {}'.format(ex))
+        write_log('   -> retrying pending options one by one: {}'.format(
+            ', '.join('{}/{}={}'.format(*entry) for entry in pending)))
+
+    for section, option, value in pending:
+        try:
+            config = get_config(camera)
+            config.get_child_by_name(section).get_child_by_name(option).set_value(value)
+            write_step('   -> applying option {}/{}={}'.format(section, option, value))
+            camera.set_config(config)
+        except gp.GPhoto2Error as ex:
+            invalidate_config()
+            write_log('   -> option {}/{}={} rejected by DSLR: {}'.format(section, option, value, ex))
+
+
 def set_config_value(camera, section, option, value):
-    """Set camera configuration. """
+    """Set camera configuration. The change is applied on the cached
+    configuration tree, call :py:func:`flush_config` to send it to the
+    camera.
+    """
     try:
         write_log('Setting option {}/{}="{}"'.format(section, option, value))
-        config = camera.get_config()
+        config = get_config(camera)
         child = config.get_child_by_name(section).get_child_by_name(option)
         if child.get_type() == gp.GP_WIDGET_RADIO:
-            choices = [c for c in child.get_choices()]
+            choices = list(child.get_choices())
         else:
             choices = None
 
         if choices and value not in choices:
             write_log("   -> invalid value '{}' for option {} (possible choices: {})".format(value, option, choices))
         child.set_value(value)
-        camera.set_config(config)
+        _CONFIG_PENDING.append((section, option, value))
     except gp.GPhoto2Error:
         write_log('   -> unsupported setting {}/{}={} (nothing configured on DSLR)'.format(section, option, value))
 
 
 def get_config_value(camera, section, option):
-    """Get camera configuration option.
+    """Get camera configuration option from the cached configuration tree.
     """
     try:
-        config = camera.get_config()
+        config = get_config(camera)
         child = config.get_child_by_name(section).get_child_by_name(option)
         value = child.get_value()
         write_log('Getting option {}/{}={}'.format(section, option, value))
@@ -110,8 +196,44 @@ def get_config_value(camera, section, option):
         write_log('Unknown option {}/{}'.format(section, option))
 
 
+def trigger_capture(camera, timeout=10):
+    """Trigger a capture and log when the camera reports the new file and
+    the end of the capture. Remaining events are drained before returning,
+    so that next commands are not disturbed.
+
+    Return the path of the new file, or None if trigger is not supported
+    by the camera.
+    """
+    try:
+        camera.trigger_capture()
+    except gp.GPhoto2Error as ex:
+        if ex.code == gp.GP_ERROR_NOT_SUPPORTED:
+            return None
+        raise
+
+    gp_path = None
+    timer = PoolingTimer(timeout)
+    while not timer.is_timeout():
+        event_type, event_data = camera.wait_for_event(1000)
+        if event_type == gp.GP_EVENT_FILE_ADDED and gp_path is None:
+            gp_path = event_data
+            write_log('   -> file {} added after {:.3f}s'.format(gp_path.name, timer.elapsed()))
+        elif event_type == gp.GP_EVENT_CAPTURE_COMPLETE:
+            write_log('   -> capture complete after {:.3f}s'.format(timer.elapsed()))
+            if gp_path is not None:
+                break
+        elif event_type == gp.GP_EVENT_TIMEOUT and gp_path is not None:
+            break  # No more pending event
+
+    if gp_path is None:
+        raise RuntimeError("No file added by DSLR after {} seconds".format(timeout))
+    return gp_path
+
+
+@functools.lru_cache(maxsize=1)
 def camera_connected():
-    """Return the list of connected camera compatible with gPhoto2.
+    """Return the list of connected camera compatible with gPhoto2
+    (detection is done only once).
     """
     if hasattr(gp, 'gp_camera_autodetect'):
         # gPhoto2 version 2.5+
@@ -126,6 +248,26 @@ def camera_connected():
 
 
 def main():
+    parser = argparse.ArgumentParser(usage="%(prog)s [options]", description="Diagnose the connected DSLR camera")
+
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help=u"log all gPhoto2 debug messages (slow down captures)")
+
+    parser.add_argument("--skip-config-dump", action='store_true',
+                        help=u"don't log all the configuration parameters of the DSLR")
+
+    parser.add_argument("--test-trigger", action='store_true',
+                        help=u"take an extra capture to test event driven capture (not used by pibooth)")
+
+    parser.add_argument("--port",
+                        help=u"port of the DSLR to diagnose (don't list all connected DSLR)")
+
+    options = parser.parse_args()
+
+    global LOGFILE
+    LOGFILE = open(APPNAME + '.log', 'w', encoding='utf-8', buffering=1 << 16)
+    atexit.register(LOGFILE.close)
+
     error = False
     configure_logging()
     write_log("Pibooth version installed: {}".format(pibooth.__version__))
@@ -152,72 +294,112 @@ def main():
         except:
             pass
 
-    gp_log_callback = gp.check_result(gp.gp_log_add_func(gp.GP_LOG_VERBOSE, gp_logging))
-    write_log("Listing all connected DSLR camera")
-    cameras_list = camera_connected()
-
-    if not cameras_list:
-        write_log('No compatible DSLR camera detected')
-        sys.exit(1)
-
-    cameras_list = sorted(cameras_list, key=lambda x: x[0])
-    for index, (name, addr) in enumerate(cameras_list):
-        write_log("{:02d} : addr-> {}  name-> {}".format(index, addr, name))
-
-    write_log("Stating diagnostic of connected DSLR camera", True)
+    if options.verbose:
+        gp_log_level = gp.GP_LOG_VERBOSE
+    else:
+        gp_log_level = gp.GP_LOG_ERROR
+    gp_log_callback = gp.check_result(gp.gp_log_add_func(gp_log_level, gp_logging))
     camera = gp.Camera()
-    camera.init()
-
-    abilities = camera.get_abilities()
-    preview_compat = gp.GP_OPERATION_CAPTURE_PREVIEW ==\
-        abilities.operations & gp.GP_OPERATION_CAPTURE_PREVIEW
-    write_log("* Preview compatible: {}".format(preview_compat))
-    capture_compat = gp.GP_OPERATION_CAPTURE_IMAGE ==\
-        abilities.operations & gp.GP_OPERATION_CAPTURE_IMAGE
-    write_log("* Capture compatible: {}".format(capture_compat))
-
-    if capture_compat:
+    if options.port:
+        write_log("Using DSLR camera on port {}".format(options.port))
+        port_info_list = gp.PortInfoList()
+        port_info_list.load()
         try:
-            print_config(camera.get_config())
-
-            write_log("Testing commands used by pibooth", True)
-
-            set_config_value(camera, 'imgsettings', 'iso', '100')
-            set_config_value(camera, 'settings', 'capturetarget', 'Memory card')
-
-            viewfinder = get_config_value(camera, 'actions', 'viewfinder')
-            if viewfinder is not None:
-                set_config_value(camera, 'actions', 'viewfinder', 1)
-
-            write_log("Take capture preview")
-            camera.capture_preview()
-
-            if viewfinder is not None:
-                set_config_value(camera, 'actions', 'viewfinder', 0)
-
-            write_log("Take a capture")
-            gp_path = camera.capture(gp.GP_CAPTURE_IMAGE)
-
-            write_log("Download file from DSLR")
-            camera_file = camera.file_get(gp_path.folder, gp_path.name, gp.GP_FILE_TYPE_NORMAL)
+            idx = port_info_list.lookup_path(options.port)
+        except gp.GPhoto2Error as ex:
+            write_log("Invalid port '{}': {}".format(options.port, ex))
+            sys.exit(1)
+        camera.set_port_info(port_info_list[idx])
+    else:
+        write_log("Listing all connected DSLR camera")
+        cameras_list = camera_connected()
 
-            write_log("Save capture locally from memory buffer")
-            data = camera_file.get_data_and_size()
-            with open(APPNAME + '.raw', 'wb') as fd:
-                fd.write(data)
-            image = Image.open(io.BytesIO(data))
-            image.save(APPNAME + '.jpg')
+        if not cameras_list:
+            write_log('No compatible DSLR camera detected')
+            sys.exit(1)
 
-        except Exception as ex:
-            write_log("ABORT   : exception occures: {}".format(ex), True)
-            error = True
+        cameras_list = sorted(cameras_list, key=itemgetter(0))
+        for index, (name, addr) in enumerate(cameras_list):
+            write_log("{:02d} : addr-> {}  name-> {}".format(index, addr, name))
 
-    if not error:
-        write_log("SUCCESS : diagnostic completed", True)
+    write_step("Stating diagnostic of connected DSLR camera", True)
+    camera.init()
 
-    del gp_log_callback
-    camera.exit()
+    try:
+        abilities = camera.get_abilities()
+        write_log("* Model: {}".format(abilities.model))
+        operations = abilities.operations
+        preview_compat = bool(operations & gp.GP_OPERATION_CAPTURE_PREVIEW)
+        write_log("* Preview compatible: {}".format(preview_compat))
+        capture_compat = bool(operations & gp.GP_OPERATION_CAPTURE_IMAGE)
+        write_log("* Capture compatible: {}".format(capture_compat))
+
+        if capture_compat:
+            try:
+                if not options.skip_config_dump:
+                    write_step("Reading all parameters of DSLR")
+                    print_config(get_config(camera))
+
+                write_log("Testing commands used by pibooth", True)
+
+                set_config_value(camera, 'imgsettings', 'iso', '100')
+                set_config_value(camera, 'settings', 'capturetarget', 'Memory card')
+
+                if preview_compat:
+                    # The viewfinder is toggled by pibooth only if the option exists
+                    viewfinder = get_config_value(camera, 'actions', 'viewfinder')
+                    if viewfinder is not None:
+                        set_config_value(camera, 'actions', 'viewfinder', 1)
+                    flush_config(camera)
+
+                    write_step("Take capture preview")
+                    camera.capture_preview()
+
+                    if viewfinder is not None:
+                        set_config_value(camera, 'actions', 'viewfinder', 0)
+                        flush_config(camera)
+                else:
+                    flush_config(camera)
+                    write_log("Skip capture preview (not supported by DSLR)")
+
+                write_step("Take a capture")
+                gp_path = camera.capture(gp.GP_CAPTURE_IMAGE)
+
+                write_step("Download file from DSLR")
+                camera_file = camera.file_get(gp_path.folder, gp_path.name, gp.GP_FILE_TYPE_NORMAL)
+
+                write_log("Save capture locally from memory buffer")
+                mime_type = camera_file.get_mime_type()
+                write_step("* File type: {}".format(mime_type))
+                if mime_type == gp.GP_MIME_JPEG:
+                    camera_file.save(APPNAME + '.jpg')
+                else:
+                    camera_file.save(APPNAME + '.raw')
+
+                if options.test_trigger:
+                    write_step("Testing event driven capture (not used by pibooth)", True)
+                    try:
+                        if trigger_capture(camera) is None:
+                            write_log("Trigger capture not supported by DSLR")
+                    except Exception as ex:
+                        write_log("   -> event driven capture failed (not used by pibooth): {}".format(ex))
+
+            except Exception as ex:
+                invalidate_config()
+                write_log("ABORT   : exception occures: {}".format(ex), True)
+                error = True
+
+        if not error:
+            write_log("SUCCESS : diagnostic completed", True)
+    finally:
+        # Always release the DSLR, else it may stay locked for next run
+        try:
+            camera.exit()
+        except gp.GPhoto2Error:
+            pass
+        del gp_log_callback
 
     write_log("If you are investigating why pibooth does not work with your DSLR camera,")
     write_log("please paste the content of generated file '{}'".format(APPNAME + '.log'))
     write_log("on https://github.com/pibooth/pibooth/issues")
+    flush_log()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import io
+import copy
+import pytest
+from pibooth.scripts import diagnostic
+
+
+class FakeGPhoto2Error(Exception):
+
+    def __init__(self, code=-1):
+        super(FakeGPhoto2Error, self).__init__(code)
+        self.code = code
+
+
+class FakeGp(object):
+
+    """Minimal subset of gphoto2 module used by the diagnostic.
+    """
+
+    GPhoto2Error = FakeGPhoto2Error
+    GP_LOG_ERROR = 0
+    GP_WIDGET_WINDOW = 0
+    GP_WIDGET_SECTION = 1
+    GP_WIDGET_TEXT = 2
+    GP_WIDGET_RANGE = 3
+    GP_WIDGET_TOGGLE = 4
+    GP_WIDGET_RADIO = 5
+    GP_WIDGET_MENU = 6
+    GP_WIDGET_BUTTON = 7
+    GP_WIDGET_DATE = 8
+
+
+class FakeWidget(object):
+
+    def __init__(self, name, wtype=FakeGp.GP_WIDGET_TEXT, value=None, children=()):
+        self.name = name
+        self.wtype = wtype
+        self.value = value
+        self.children = list(children)
+
+    def get_name(self):
+        return self.name
+
+    def get_label(self):
+        return self.name.capitalize()
+
+    def get_readonly(self):
+        return False
+
+    def get_type(self):
+        return self.wtype
+
+    def get_value(self):
+        return self.value
+
+    def set_value(self, value):
+        self.value = value
+
+    def get_children(self):
+        return iter(self.children)
+
+    def get_child_by_name(self, name):
+        for child in self.children:
+            if child.name == name:
+                return child
+        raise FakeGPhoto2Error()
+
+    def values(self):
+        result = {}
+        for section in self.children:
+            for child in section.children:
+                result['{}/{}'.format(section.name, child.name)] = child.value
+        return result
+
+
+class FakeCamera(object):
+
+    def __init__(self, rejected=()):
+        self.rejected = rejected
+        self.config = FakeWidget('main', FakeGp.GP_WIDGET_WINDOW, children=[
+            FakeWidget('imgsettings', FakeGp.GP_WIDGET_SECTION, children=[FakeWidget('iso', value='200')]),
+            FakeWidget('settings', FakeGp.GP_WIDGET_SECTION, children=[FakeWidget('capturetarget', value='Internal RAM')]),
+        ])
+        self.get_count = 0
+        self.set_calls = []
+
+    def get_config(self):
+        self.get_count += 1
+        return copy.deepcopy(self.config)
+
+    def set_config(self, config):
+        self.set_calls.append(config.values())
+        for key, value in config.values().items():
+            if (key, value) in self.rejected:
+                raise FakeGPhoto2Error()
+        self.config = copy.deepcopy(config)
+
+
+@pytest.fixture
+def diag(monkeypatch):
+    monkeypatch.setattr(diagnostic, 'gp', FakeGp)
+    monkeypatch.setattr(diagnostic, 'LOGFILE', io.StringIO())
+    diagnostic.invalidate_config()
+    yield diagnostic
+    diagnostic.invalidate_config()
+
+
+def test_set_config_batched(diag):
+    camera = FakeCamera()
+    diag.set_config_value(camera, 'imgsettings', 'iso', '100')
+    diag.set_config_value(camera, 'settings', 'capturetarget', 'Memory card')
+    diag.flush_config(camera)
+    assert camera.get_count == 1
+    assert camera.set_calls == [{'imgsettings/iso': '100', 'settings/capturetarget': 'Memory card'}]
+
+
+def test_set_config_nothing_pending(diag):
+    camera = FakeCamera()
+    diag.flush_config(camera)
+    assert camera.set_calls == []
+
+
+def test_unknown_option_keeps_pending_changes(diag):
+    camera = FakeCamera()
+    diag.set_config_value(camera, 'imgsettings', 'iso', '100')
+    assert diag.get_config_value(camera, 'actions', 'viewfinder') is None
+    diag.flush_config(camera)
+    assert camera.config.values()['imgsettings/iso'] == '100'
+
+
+def test_rejected_config_retried_by_option(diag):
+    camera = FakeCamera(rejected=[('imgsettings/iso', '100')])
+    diag.set_config_value(camera, 'imgsettings', 'iso', '100')
+    diag.set_config_value(camera, 'settings', 'capturetarget', 'Memory card')
+    diag.flush_config(camera)
+    assert len(camera.set_calls) == 3  # Batch then each option
+    assert camera.config.values() == {'imgsettings/iso': '200', 'settings/capturetarget': 'Memory card'}
+    assert 'option imgsettings/iso=100 rejected by DSLR' in diag.LOGFILE.getvalue()
+
+
+def test_print_config_order(diag):
+
+    def walk(config, parent=''):
+        # Recursive reference implementation
+        for child in config.get_children():
+            path = '/'.join((parent, child.get_name()))
+            if child.get_type() == FakeGp.GP_WIDGET_SECTION:
+                yield from walk(child, path)
+            else:
+                yield path
+
+    config = FakeWidget('main', FakeGp.GP_WIDGET_WINDOW, children=[
+        FakeWidget('first'),
+        FakeWidget('section1', FakeGp.GP_WIDGET_SECTION, children=[
+            FakeWidget('a'),
+            FakeWidget('section2', FakeGp.GP_WIDGET_SECTION, children=[FakeWidget('b'), FakeWidget('c')]),
+            FakeWidget('d'),
+        ]),
+        FakeWidget('section3', FakeGp.GP_WIDGET_SECTION),
+        FakeWidget('last'),
+    ])
+    diag.print_config(config)
+    paths = [line for line in diag.LOGFILE.getvalue().splitlines() if line.startswith('/')]
+    assert paths == list(walk(config))
+    assert paths == ['/first', '/section1/a', '/section1/section2/b', '/section1/section2/c', '/section1/d', '/last']